@@ -1,9 +1,13 @@
 # analytics.py
 from __future__ import annotations
 
+import heapq
 from collections import defaultdict
 from datetime import date, datetime, timedelta, timezone
-from typing import Any, Dict, List, Optional, Tuple
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+import ahocorasick
 
 # ----------------------------
 # Base normalization buckets
@@ -23,9 +27,39 @@ HOME_FOOD_KEYWORDS = {
 }
 FOOD_EXPENSIVE_RS = 1800
 
+# Raw category substrings -> normalized category; earlier rules win
+CATEGORY_RULES = [
+    ("utility", "utility"),
+    ("fund", "funds_transfer"),
+    ("transfer", "funds_transfer"),
+    ("groc", "grocery"),
+    ("shop", "shopping"),
+    ("fuel", "fuel"),
+    ("petrol", "fuel"),
+    ("food", "food"),
+    ("rent", "rent"),
+]
+
+def _build_automaton(words: List[Tuple[str, Any]]) -> ahocorasick.Automaton:
+    ac = ahocorasick.Automaton()
+    for kw, value in words:
+        ac.add_word(kw, value)
+    ac.make_automaton()
+    return ac
+
+# One linear scan per text instead of one substring search per keyword.
+# No token-level prefilter (set/Bloom) in front of it: keywords match as substrings
+# ("super" in "supermarket", "mart" in "walmart"), which whole-word tokens would miss.
+_FOOD_AC = _build_automaton(
+    [(k, "restaurant") for k in RESTAURANT_KEYWORDS] + [(k, "home") for k in HOME_FOOD_KEYWORDS]
+)
+_CATEGORY_AC = _build_automaton([(k, (i, label)) for i, (k, label) in enumerate(CATEGORY_RULES)])
+
 # ----------------------------
 # Date helpers required by app.py
+# (pure functions of small domains -> memoized)
 # ----------------------------
+@lru_cache(maxsize=512)
 def parse_yyyy_mm(s: str) -> Tuple[int, int]:
     s = (s or "").strip()
     y, m = s.split("-")
@@ -39,6 +73,7 @@ def parse_yyyy_mm_dd(s: str) -> date:
     s = (s or "").strip()
     return date.fromisoformat(s)
 
+@lru_cache(maxsize=512)
 def month_bounds_utc(month: str) -> Tuple[datetime, datetime]:
     y, m = parse_yyyy_mm(month)
     start = datetime(y, m, 1, 0, 0, 0, tzinfo=timezone.utc)
@@ -56,42 +91,25 @@ def range_bounds_utc(start_d: date, end_d: date) -> Tuple[datetime, datetime]:
     end = datetime(end_d.year, end_d.month, end_d.day, 0, 0, 0, tzinfo=timezone.utc)
     return start, end
 
+@lru_cache(maxsize=512)
 def prev_month_str(month: str) -> str:
     y, m = parse_yyyy_mm(month)
     if m == 1:
         return f"{y-1}-12"
     return f"{y}-{m-1:02d}"
 
-def _month_str(d: date) -> str:
-    return f"{d.year}-{d.month:02d}"
-
-def split_range_by_month(start: date, end: date) -> List[str]:
+@lru_cache(maxsize=512)
+def split_range_by_month(start: date, end: date) -> Tuple[str, ...]:
     """
-    Returns list of YYYY-MM that overlap [start, end)
+    Returns YYYY-MM months that overlap [start, end)
+    (a tuple, since results are cached and shared between callers)
     """
     if end <= start:
-        return []
-    cur = date(start.year, start.month, 1)
-    out: List[str] = []
-    while cur < end:
-        out.append(_month_str(cur))
-        # next month
-        if cur.month == 12:
-            cur = date(cur.year + 1, 1, 1)
-        else:
-            cur = date(cur.year, cur.month + 1, 1)
-    # ensure month containing start included
-    sm = _month_str(start)
-    if sm not in out:
-        out.insert(0, sm)
-    # de-dupe keep order
-    seen = set()
-    final = []
-    for x in out:
-        if x not in seen:
-            seen.add(x)
-            final.append(x)
-    return final
+        return ()
+    # Months from start's month through end's month; end's month only if [start, end) reaches into it
+    first = start.year * 12 + start.month - 1
+    n = (end.year - start.year) * 12 + (end.month - start.month) + (1 if end.day > 1 else 0)
+    return tuple(f"{(first + i) // 12}-{(first + i) % 12 + 1:02d}" for i in range(n))
 
 def prorate_monthly_budget_for_range(*, user_id: str, start: date, end: date) -> float:
     """
@@ -146,6 +164,10 @@ def _to_float(x: Any) -> float:
         return 0.0
 
 def _text_blob(entry: Dict[str, Any]) -> str:
+    # Rows from db.py come with the blob already built by Postgres
+    blob = entry.get("search_blob")
+    if blob is not None:
+        return blob
     parts = [
         entry.get("title"),
         entry.get("beneficiary_name"),
@@ -167,45 +189,45 @@ def _parse_ts(ts: Any) -> Optional[datetime]:
         return None
 
 def normalize_category(entry: Dict[str, Any]) -> str:
-    cn = (entry.get("category_normalized") or "").strip().lower()
+    return _normalize_category_pair(entry.get("category_normalized"), entry.get("category"))
+
+@lru_cache(maxsize=4096)
+def _normalize_category_pair(category_normalized: Optional[str], category: Optional[str]) -> str:
+    # Users have few distinct categories, so each pair is normalized once per process
+    cn = (category_normalized or "").strip().lower()
     if cn:
         return cn
 
-    c = (entry.get("category") or "").strip().lower()
-
-    if "utility" in c:
-        return "utility"
-    if "fund" in c or "transfer" in c:
-        return "funds_transfer"
-    if "groc" in c:
-        return "grocery"
-    if "shop" in c:
-        return "shopping"
-    if "fuel" in c or "petrol" in c:
-        return "fuel"
-    if "food" in c:
-        return "food"
-    if "rent" in c:
-        return "rent"
+    c = (category or "").strip().lower()
+
+    best = min((hit for _, hit in _CATEGORY_AC.iter(c)), default=None)
+    if best:
+        return best[1]
     return c or "other"
 
 def classify_food_unnecessary(entry: Dict[str, Any]) -> Tuple[bool, str]:
     blob = _text_blob(entry)
     amt = _to_float(entry.get("amount"))
 
-    if any(k in blob for k in HOME_FOOD_KEYWORDS):
-        return False, "home_food_keyword"
-    if any(k in blob for k in RESTAURANT_KEYWORDS):
+    restaurant_hit = False
+    for _, label in _FOOD_AC.iter(blob):
+        if label == "home":
+            return False, "home_food_keyword"
+        restaurant_hit = True
+    if restaurant_hit:
         return True, "restaurant_keyword"
     if amt >= FOOD_EXPENSIVE_RS:
         return True, "expensive_food_amount"
     return False, "unknown_food_type"
 
 def _day_key(dt: datetime) -> str:
-    return dt.astimezone(timezone.utc).date().isoformat()
+    # Timestamps usually arrive UTC-aware already; skip the no-op conversion
+    if dt.tzinfo is not timezone.utc:
+        dt = dt.astimezone(timezone.utc)
+    return dt.date().isoformat()
 
 def compute_insights(
-    entries: List[Dict[str, Any]],
+    entries: Union[Iterable[Dict[str, Any]], Dict[str, Any]],
     budget_row: Dict[str, Any],
     *,
     period: str = "month",
@@ -220,43 +242,105 @@ def compute_insights(
 
     discretionary = 0.0
     restaurant_food = 0.0
+    rent = 0.0
 
-    EXCLUDE_CATS = {"funds_transfer"}
-
-    for e in entries:
-        amt = _to_float(e.get("amount"))
-        if amt <= 0:
-            continue
-
-        catn = normalize_category(e)
-        if catn in EXCLUDE_CATS:
-            continue
+    # Running day stats (totals only grow, so the running max is the final max)
+    day_sum = 0.0
+    day_max = 0.0
 
-        spent += amt
-        totals_by_cat[catn] += amt
+    EXCLUDE_CATS = {"funds_transfer"}
 
-        dt = _parse_ts(e.get("created_at"))
-        if dt:
-            daily_totals[_day_key(dt)] += amt
+    # Hot-loop locals (avoid global lookups per row)
+    to_float = _to_float
+    parse_ts = _parse_ts
+    day_key = _day_key
+    normalize = normalize_category
+    classify_food = classify_food_unnecessary
+    discretionary_base = DISCRETIONARY_BASE
+
+    if isinstance(entries, dict):
+        # Pre-aggregated month from db.fetch_month_aggregates: sums are already
+        # done in SQL, only food rows come back individually for classification.
+        for b in entries.get("buckets") or []:
+            amt = to_float(b.get("total"))
+            if amt <= 0:
+                continue
+
+            catn = normalize(b)
+            if catn in EXCLUDE_CATS:
+                continue
+
+            spent += amt
+            totals_by_cat[catn] += amt
+
+            if catn == "rent":
+                rent += amt
+
+            # Day key arrives as 'YYYY-MM-DD' text from SQL, same as _day_key()
+            dk = b.get("day")
+            if dk:
+                day_total = daily_totals[dk] + amt
+                daily_totals[dk] = day_total
+                day_sum += amt
+                if day_total > day_max:
+                    day_max = day_total
+
+            if catn in discretionary_base:
+                discretionary += amt
 
-        if catn in DISCRETIONARY_BASE:
-            discretionary += amt
+        for e in entries.get("food_entries") or []:
+            amt = to_float(e.get("amount"))
+            if amt <= 0 or normalize(e) != "food":
+                continue
 
-        if catn == "food":
-            is_rest, _reason = classify_food_unnecessary(e)
+            is_rest, _reason = classify_food(e)
             if is_rest:
                 restaurant_food += amt
                 discretionary += amt
+    else:
+        for e in entries:
+            amt = to_float(e.get("amount"))
+            if amt <= 0:
+                continue
+
+            catn = normalize(e)
+            if catn in EXCLUDE_CATS:
+                continue
+
+            spent += amt
+            totals_by_cat[catn] += amt
+
+            if catn == "rent":
+                rent += amt
+
+            dt = parse_ts(e.get("created_at"))
+            if dt:
+                dk = day_key(dt)
+                day_total = daily_totals[dk] + amt
+                daily_totals[dk] = day_total
+                day_sum += amt
+                if day_total > day_max:
+                    day_max = day_total
+
+            if catn in discretionary_base:
+                discretionary += amt
 
-    top = sorted(totals_by_cat.items(), key=lambda kv: kv[1], reverse=True)
-    top5 = [{"category": k, "amount": round(v, 2)} for k, v in top[:5]]
+            if catn == "food":
+                is_rest, _reason = classify_food(e)
+                if is_rest:
+                    restaurant_food += amt
+                    discretionary += amt
+
+    top5 = [
+        {"category": k, "amount": round(v, 2)}
+        for k, v in heapq.nlargest(5, totals_by_cat.items(), key=lambda kv: kv[1])
+    ]
 
     warnings: List[str] = []
 
     if budget_amount > 0 and spent > budget_amount:
         warnings.append("OVER_BUDGET")
 
-    rent = totals_by_cat.get("rent", 0.0)
     if budget_amount > 0 and rent / budget_amount >= 0.45:
         warnings.append("RENT_HIGH")
 
@@ -267,9 +351,8 @@ def compute_insights(
         warnings.append("RESTAURANT_FOOD_HIGH")
 
     if daily_totals:
-        vals = list(daily_totals.values())
-        avg_day = sum(vals) / max(1, len(vals))
-        max_day = max(vals)
+        avg_day = day_sum / len(daily_totals)
+        max_day = day_max
         if avg_day > 0 and max_day >= avg_day * 2.5 and max_day >= 5000:
             warnings.append("SPIKE_DETECTED")
 
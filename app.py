@@ -3,14 +3,16 @@ from dotenv import load_dotenv
 load_dotenv()
 
 from flask import Flask, request, jsonify
+from flask.json.provider import JSONProvider
+from cachetools import TTLCache
 from datetime import date, datetime, timedelta, timezone
-from typing import Any, Dict, Optional, Tuple
-import time
-import hashlib
-import json
+from typing import Any, Dict, Optional, Union
+import threading
+import orjson
+import xxhash
 
 from config import AGENT_API_KEY, LLM_ENABLED, LLM_PROVIDER
-from db import fetch_month_budget, fetch_entries_for_month
+from db import ensure_indexes, fetch_budgets, fetch_aggregates_for_months
 from analytics import (
     compute_insights,
     range_bounds_utc,
@@ -22,12 +24,24 @@ from analytics import (
 )
 from llm_ai import llm_summarize
 
+class OrjsonProvider(JSONProvider):
+    """Flask JSON (request.get_json / jsonify) backed by orjson."""
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s: Union[str, bytes], **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # ----------------------------
 # SMART CACHE (fingerprint-based)
 # ----------------------------
-_LLM_CACHE: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+# Bounded + expiring, so long-lived processes don't grow forever
+_LLM_CACHE: TTLCache = TTLCache(maxsize=4096, ttl=3600)
+_LLM_CACHE_LOCK = threading.Lock()
 
 def _fingerprint(insights: Dict[str, Any]) -> str:
     core = {
@@ -36,8 +50,8 @@ def _fingerprint(insights: Dict[str, Any]) -> str:
         "warnings": insights.get("warnings"),
         "top_categories": insights.get("top_categories"),
     }
-    raw = json.dumps(core, sort_keys=True)
-    return hashlib.md5(raw.encode()).hexdigest()
+    raw = orjson.dumps(core, option=orjson.OPT_SORT_KEYS)
+    return xxhash.xxh3_64_hexdigest(raw)
 
 def _maybe_llm_summary(user_id: str, period: str, period_key: str, insights: Dict[str, Any]) -> Optional[Dict[str, Any]]:
     if not LLM_ENABLED:
@@ -46,14 +60,16 @@ def _maybe_llm_summary(user_id: str, period: str, period_key: str, insights: Dic
     fp = _fingerprint(insights)
     cache_key = f"{user_id}::{period}::{period_key}::{fp}"
 
-    cached = _LLM_CACHE.get(cache_key)
-    if cached:
-        return cached[1]
+    with _LLM_CACHE_LOCK:
+        cached = _LLM_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
 
     out = llm_summarize(insights)
 
     if isinstance(out, dict):
-        _LLM_CACHE[cache_key] = (time.time(), out)
+        with _LLM_CACHE_LOCK:
+            _LLM_CACHE[cache_key] = out
         return out
 
     return None
@@ -90,15 +106,26 @@ def agent_monthly():
     except Exception:
         return jsonify({"error": "month must be YYYY-MM"}), 400
 
-    budget = fetch_month_budget(user_id, month)
+    # Current + previous month in one query per table
+    pm = prev_month_str(month)
+    months = [month, pm] if include_compare else [month]
+
+    budgets = fetch_budgets(user_id, months)
+    budget = budgets.get(month)
     if not budget:
         return jsonify({"error": "monthly_budgets row not found"}), 404
 
-    entries = fetch_entries_for_month(user_id, month)
-    insights = compute_insights(entries, budget, period="month", period_key=month)
+    # No previous budget -> no compare, so skip scanning that month's entries
+    aggregates = fetch_aggregates_for_months(user_id, [m for m in months if m in budgets])
+    insights = compute_insights(aggregates[month], budget, period="month", period_key=month)
 
     if include_compare:
-        insights = _add_compare_section(user_id=user_id, month=month, insights=insights)
+        insights = _add_compare_section(
+            month=month,
+            insights=insights,
+            prev_budget=budgets.get(pm),
+            prev_aggregates=aggregates.get(pm),
+        )
 
     ai = None
     if include_ai:
@@ -109,24 +136,28 @@ def agent_monthly():
 # ----------------------------
 # COMPARE SECTION
 # ----------------------------
-def _add_compare_section(*, user_id: str, month: str, insights: Dict[str, Any]) -> Dict[str, Any]:
+def pct_change(cur: float, prev: float) -> Optional[float]:
+    if prev <= 0:
+        return None
+    return round(((cur - prev) / prev) * 100.0, 2)
+
+def _add_compare_section(
+    *,
+    month: str,
+    insights: Dict[str, Any],
+    prev_budget: Optional[Dict[str, Any]],
+    prev_aggregates: Optional[Dict[str, Any]],
+) -> Dict[str, Any]:
     pm = prev_month_str(month)
-    prev_budget = fetch_month_budget(user_id, pm)
-    if not prev_budget:
+    if not prev_budget or prev_aggregates is None:
         insights["compare_prev"] = None
         return insights
 
-    prev_entries = fetch_entries_for_month(user_id, pm)
-    prev_ins = compute_insights(prev_entries, prev_budget, period="month", period_key=pm)
+    prev_ins = compute_insights(prev_aggregates, prev_budget, period="month", period_key=pm)
 
     cur_spent = float(insights.get("spent_total", 0.0))
     prev_spent = float(prev_ins.get("spent_total", 0.0))
 
-    def pct_change(cur: float, prev: float):
-        if prev <= 0:
-            return None
-        return round(((cur - prev) / prev) * 100.0, 2)
-
     insights["compare_prev"] = {
         "prev_month": pm,
         "spent_prev": round(prev_spent, 2),
@@ -135,5 +166,12 @@ def _add_compare_section(*, user_id: str, month: str, insights: Dict[str, Any])
     return insights
 
 if __name__ == "__main__":
+    # Dev server only; production deploys run `python db.py` once instead
+    try:
+        ensure_indexes()
+    except Exception as e:
+        # Don't block startup on it (DB unreachable, missing privileges, ...)
+        app.logger.warning("ensure_indexes failed: %s", e)
+
     print("Starting Flask on http://127.0.0.1:5050 ...")
     app.run(host="0.0.0.0", port=5050, debug=False)
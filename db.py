@@ -1,13 +1,24 @@
 # db.py
+import logging
 import os
 import socket
-import time
+import threading
 from contextlib import contextmanager
 from datetime import datetime, timezone
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, Iterator, Optional, Sequence, Tuple
 
 import psycopg
+from cachetools import TTLCache, cached
+from dotenv import load_dotenv
+from psycopg.conninfo import make_conninfo
 from psycopg.rows import dict_row
+from psycopg.sql import SQL, Identifier
+from psycopg_pool import ConnectionPool
+
+# Loaded here too so `python db.py` (index bootstrap) sees the same settings as the app
+load_dotenv()
+
+logger = logging.getLogger(__name__)
 
 # Read DB connection settings from .env
 DB_HOST = os.getenv("DB_HOST", "").strip()
@@ -19,8 +30,10 @@ DB_SSLMODE = os.getenv("DB_SSLMODE", "require").strip()
 
 # Optional tuning
 DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "10"))  # seconds
-DB_MAX_RETRIES = int(os.getenv("DB_MAX_RETRIES", "3"))
-DB_RETRY_BASE_SLEEP = float(os.getenv("DB_RETRY_BASE_SLEEP", "0.6"))  # seconds
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_FETCH_ITERSIZE = int(os.getenv("DB_FETCH_ITERSIZE", "1000"))  # rows per server-side cursor fetch
+DB_ENSURE_INDEXES = os.getenv("DB_ENSURE_INDEXES", "true").strip().lower() in ("1", "true", "yes", "y", "on")
 
 def _require_env() -> None:
     if not DB_HOST or not DB_PASSWORD:
@@ -31,6 +44,8 @@ def _resolve_hostaddr_ipv4(host: str) -> Optional[str]:
     Prefer IPv4 to avoid Windows+SSL issues when DNS returns IPv6 only/first.
     Returns an IPv4 address string or None if not found.
     """
+    if not host:
+        return None
     try:
         infos = socket.getaddrinfo(host, DB_PORT, family=socket.AF_INET, type=socket.SOCK_STREAM)
         if infos:
@@ -39,46 +54,107 @@ def _resolve_hostaddr_ipv4(host: str) -> Optional[str]:
         pass
     return None
 
+# Resolved once at import; only re-resolved after a connection failure
+_HOSTADDR_CACHE: Optional[str] = _resolve_hostaddr_ipv4(DB_HOST)
+
+def _conninfo() -> str:
+    return make_conninfo(
+        host=DB_HOST,
+        hostaddr=_HOSTADDR_CACHE,  # <-- forces IPv4 when available
+        port=DB_PORT,
+        dbname=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        sslmode=DB_SSLMODE,
+        connect_timeout=DB_CONNECT_TIMEOUT,
+        keepalives=1,
+        keepalives_idle=30,
+        keepalives_interval=10,
+        keepalives_count=5,
+    )
+
+# One pool per process, opened on first get_conn().
+# Broken connections are checked on checkout and replaced by the pool.
+POOL = ConnectionPool(
+    conninfo=_conninfo(),
+    min_size=DB_POOL_MIN_SIZE,
+    max_size=DB_POOL_MAX_SIZE,
+    kwargs={"row_factory": dict_row},
+    check=ConnectionPool.check_connection,
+    timeout=DB_CONNECT_TIMEOUT,
+    open=False,
+)
+
+def _refresh_hostaddr() -> None:
+    """
+    The DB host may have moved (failover, new IP); re-resolve and point new pool
+    connections at the fresh address.
+    """
+    global _HOSTADDR_CACHE
+    hostaddr = _resolve_hostaddr_ipv4(DB_HOST)
+    if hostaddr and hostaddr != _HOSTADDR_CACHE:
+        _HOSTADDR_CACHE = hostaddr
+        POOL.conninfo = _conninfo()
+
 @contextmanager
 def get_conn():
     _require_env()
+    POOL.open()
+    try:
+        with POOL.connection() as conn:
+            yield conn
+    except psycopg.OperationalError:
+        _refresh_hostaddr()
+        raise
 
-    hostaddr = _resolve_hostaddr_ipv4(DB_HOST)
+# (user_id, created_at) serves every per-user month/range scan already in order;
+# the INCLUDE columns let the aggregate query run as an index-only scan.
+INDEXES = {
+    "entries_user_created_idx": """
+    create index concurrently if not exists entries_user_created_idx
+      on entries (user_id, created_at)
+      include (amount, category, category_normalized);
+    """,
+}
+
+def ensure_indexes() -> None:
+    """
+    One-shot bootstrap: run as a deploy step (`python db.py`) or from app.py's
+    dev-server entrypoint, never on import.
+
+    Uses its own short-lived autocommit connection (CONCURRENTLY can't run inside a
+    transaction) so it never opens or touches POOL. An interrupted CONCURRENTLY build
+    leaves an INVALID index that IF NOT EXISTS would skip forever; those are dropped
+    and rebuilt.
+    """
+    if not DB_ENSURE_INDEXES:
+        return
+    _require_env()
 
-    last_exc: Optional[Exception] = None
-    for attempt in range(1, DB_MAX_RETRIES + 1):
-        try:
-            conn = psycopg.connect(
-                host=DB_HOST,
-                hostaddr=hostaddr,          # <-- forces IPv4 when available
-                port=DB_PORT,
-                dbname=DB_NAME,
-                user=DB_USER,
-                password=DB_PASSWORD,
-                sslmode=DB_SSLMODE,
-                connect_timeout=DB_CONNECT_TIMEOUT,
-                keepalives=1,
-                keepalives_idle=30,
-                keepalives_interval=10,
-                keepalives_count=5,
-                row_factory=dict_row,
-            )
-            try:
-                yield conn
-            finally:
-                conn.close()
-            return
-        except psycopg.OperationalError as e:
-            last_exc = e
-            # small backoff
-            if attempt < DB_MAX_RETRIES:
-                time.sleep(DB_RETRY_BASE_SLEEP * attempt)
-            else:
-                raise
-
-    # Should never reach here
-    if last_exc:
-        raise last_exc
+    with psycopg.connect(_conninfo(), autocommit=True) as conn:
+        for name, ddl in INDEXES.items():
+            row = conn.execute(
+                """
+                select i.indisvalid
+                from pg_index i
+                join pg_class c on c.oid = i.indexrelid
+                where c.relname = %s and pg_table_is_visible(c.oid);
+                """,
+                (name,),
+            ).fetchone()
+            if row is not None and not row[0]:
+                logger.error("index %s is INVALID (interrupted build); rebuilding", name)
+                conn.execute(SQL("drop index concurrently if exists {}").format(Identifier(name)))
+            conn.execute(ddl)
+
+# Lowercased text used by analytics keyword matching (see analytics._text_blob)
+_SEARCH_BLOB_SQL = """lower(concat_ws(' ',
+        nullif(title, ''),
+        nullif(beneficiary_name, ''),
+        nullif(raw_text, ''),
+        nullif(category, ''),
+        nullif(category_normalized, '')
+      )) as search_blob"""
 
 def _month_bounds(month: str) -> Tuple[datetime, datetime]:
     """
@@ -96,10 +172,14 @@ def _month_bounds(month: str) -> Tuple[datetime, datetime]:
         end = datetime(year, mon + 1, 1, 0, 0, 0, tzinfo=timezone.utc)
     return start, end
 
+# Budgets rarely change; a short TTL collapses repeated lookups (e.g. weekly proration)
+@cached(cache=TTLCache(maxsize=8192, ttl=60), lock=threading.Lock())
 def fetch_month_budget(user_id: str, month: str) -> Optional[Dict[str, Any]]:
     """
     Expects table: monthly_budgets
       columns typically: user_id (uuid), month (text), amount (numeric), home_city (text)
+
+    Results (including "not found") are cached per (user_id, month) for 60s.
     """
     sql = """
     select
@@ -117,14 +197,18 @@ def fetch_month_budget(user_id: str, month: str) -> Optional[Dict[str, Any]]:
             row = cur.fetchone()
             return dict(row) if row else None
 
-def fetch_entries_for_month(user_id: str, month: str) -> List[Dict[str, Any]]:
+def fetch_entries_for_month(user_id: str, month: str) -> Iterator[Dict[str, Any]]:
     """
     Expects table: entries
       must have: user_id, created_at, amount, category, plus optional fields used by analytics
+
+    Streams rows through a server-side cursor (DB_FETCH_ITERSIZE per round-trip) so big
+    months are never fully materialized. Lazy: the query runs when iteration starts and
+    a pooled connection is held until the generator is exhausted or closed.
     """
     start, end = _month_bounds(month)
 
-    sql = """
+    sql = f"""
     select
       id,
       user_id,
@@ -137,7 +221,8 @@ def fetch_entries_for_month(user_id: str, month: str) -> List[Dict[str, Any]]:
       beneficiary_name,
       image_path,
       location_name,
-      category_normalized
+      category_normalized,
+      {_SEARCH_BLOB_SQL}
     from entries
     where user_id = %s
       and created_at >= %s
@@ -146,13 +231,109 @@ def fetch_entries_for_month(user_id: str, month: str) -> List[Dict[str, Any]]:
     """
 
     with get_conn() as conn:
-        with conn.cursor() as cur:
+        with conn.cursor(name="entries_iter") as cur:
+            cur.itersize = DB_FETCH_ITERSIZE
             cur.execute(sql, (user_id, start, end))
-            rows = cur.fetchall() or []
-            return [dict(r) for r in rows]
+            for row in cur:
+                yield dict(row)
 
-def fetch_entry(entry_id: str) -> Optional[Dict[str, Any]]:
+def fetch_budgets(user_id: str, months: Sequence[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Batched fetch_month_budget: one round-trip for several months.
+    Returns {month: budget_row}; months without a row are simply missing.
+    """
     sql = """
+    select
+      user_id,
+      month,
+      amount::float8 as budget_amount,
+      home_city
+    from monthly_budgets
+    where user_id = %s and month = any(%s);
+    """
+    out: Dict[str, Dict[str, Any]] = {}
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql, (user_id, list(months)))
+            for row in cur.fetchall() or []:
+                out.setdefault(row["month"], dict(row))
+    return out
+
+def fetch_month_aggregates(user_id: str, month: str) -> Dict[str, Any]:
+    return fetch_aggregates_for_months(user_id, [month])[month]
+
+def fetch_aggregates_for_months(user_id: str, months: Sequence[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Pre-aggregated view of each month for compute_insights:
+      buckets: per (category, category_normalized, UTC day 'YYYY-MM-DD') sums of positive amounts
+      food_entries: only food-like rows, with the search_blob classify_food_unnecessary needs
+
+    All months are read with one range scan per query and split by UTC month here.
+    """
+    bounds = [_month_bounds(m) for m in months]
+    start = min(b[0] for b in bounds)
+    end = max(b[1] for b in bounds)
+
+    # Rows are labelled 'YYYY-MM' by SQL; callers may pass unpadded months ('2024-3')
+    by_label: Dict[str, Dict[str, Any]] = {}
+    out: Dict[str, Dict[str, Any]] = {}
+    for m, (ms, _me) in zip(months, bounds):
+        label = f"{ms.year}-{ms.month:02d}"
+        if label not in by_label:
+            by_label[label] = {"buckets": [], "food_entries": []}
+        out[m] = by_label[label]
+
+    buckets_sql = """
+    select
+      to_char(created_at at time zone 'utc', 'YYYY-MM') as month,
+      category,
+      category_normalized,
+      to_char(created_at at time zone 'utc', 'YYYY-MM-DD') as day,
+      sum(amount)::float8 as total,
+      count(*) as n
+    from entries
+    where user_id = %s
+      and created_at >= %s
+      and created_at < %s
+      and amount > 0
+    group by 1, 2, 3, 4;
+    """
+
+    # Superset of normalize_category(...) == "food": no trimming here (SQL trim() only
+    # strips spaces, str.strip() all whitespace), analytics re-checks in Python.
+    food_sql = f"""
+    select
+      to_char(created_at at time zone 'utc', 'YYYY-MM') as month,
+      category,
+      category_normalized,
+      amount::float8 as amount,
+      {_SEARCH_BLOB_SQL}
+    from entries
+    where user_id = %s
+      and created_at >= %s
+      and created_at < %s
+      and amount > 0
+      and (
+        lower(category_normalized) like '%%food%%'
+        or lower(category) like '%%food%%'
+      );
+    """
+
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(buckets_sql, (user_id, start, end))
+            for row in cur.fetchall() or []:
+                if row["month"] in by_label:
+                    by_label[row["month"]]["buckets"].append(dict(row))
+            cur.execute(food_sql, (user_id, start, end))
+            for row in cur.fetchall() or []:
+                if row["month"] in by_label:
+                    by_label[row["month"]]["food_entries"].append(dict(row))
+
+    return out
+
+def fetch_entry(entry_id: str) -> Optional[Dict[str, Any]]:
+    sql = f"""
     select
       id,
       user_id,
@@ -165,7 +346,8 @@ def fetch_entry(entry_id: str) -> Optional[Dict[str, Any]]:
       beneficiary_name,
       image_path,
       location_name,
-      category_normalized
+      category_normalized,
+      {_SEARCH_BLOB_SQL}
     from entries
     where id = %s
     limit 1;
@@ -175,3 +357,8 @@ def fetch_entry(entry_id: str) -> Optional[Dict[str, Any]]:
             cur.execute(sql, (entry_id,))
             row = cur.fetchone()
             return dict(row) if row else None
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    ensure_indexes()
+    print("indexes ok")
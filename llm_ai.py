@@ -1,9 +1,10 @@
 # llm_ai.py
-import json
 import time
 import os
+from functools import lru_cache
 from typing import Any, Dict, Optional
 
+import orjson
 from dotenv import load_dotenv
 from openai import OpenAI
 
@@ -61,7 +62,9 @@ def _rate_limit_wait() -> None:
     _WINDOW_COUNT += 1
 
 
+@lru_cache(maxsize=1)
 def _client() -> OpenAI:
+    # Built once so the underlying httpx pool keeps HTTPS connections alive between calls
     return OpenAI(
         base_url="https://openrouter.ai/api/v1",
         api_key=OPENROUTER_API_KEY,
@@ -78,23 +81,23 @@ def _headers() -> Dict[str, str]:
 
 
 def _extract_first_json(text: str) -> Optional[Dict[str, Any]]:
-    text = (text or "").strip()
-    if not text:
+    raw = (text or "").strip().encode()
+    if not raw:
         return None
 
     # Strict parse
     try:
-        v = json.loads(text)
+        v = orjson.loads(raw)
         return v if isinstance(v, dict) else None
     except Exception:
         pass
 
     # Fallback: first {...}
-    s = text.find("{")
-    e = text.rfind("}")
+    s = raw.find(b"{")
+    e = raw.rfind(b"}")
     if s >= 0 and e > s:
         try:
-            v = json.loads(text[s : e + 1])
+            v = orjson.loads(raw[s : e + 1])
             return v if isinstance(v, dict) else None
         except Exception:
             return None
@@ -136,7 +139,7 @@ def llm_summarize(insights: Dict[str, Any]) -> Optional[Dict[str, Any]]:
             extra_headers=_headers(),
             messages=[
                 {"role": "system", "content": system},
-                {"role": "user", "content": json.dumps(user_payload, ensure_ascii=False)},
+                {"role": "user", "content": orjson.dumps(user_payload).decode()},
             ],
             temperature=0.3,
         )